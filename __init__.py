@@ -11,31 +11,44 @@ datadog_forwarder:
     flush_period_sec: 60
     api_key: my_api_key
     app_key: my_app_key
+    site: datadoghq.eu
+
+app_key is optional and ignored, submitting metrics only needs the api_key.
+It is still accepted so that existing configurations keep validating.
+
+site is the Datadog site metrics are sent to, it defaults to the DD_SITE
+environment variable when set and to datadoghq.com otherwise.
 
 """
 
 from __future__ import annotations
 
+import os
+import gzip
 import time
+import queue
 import logging
+import threading
 
-from datadog_api_client.v2.model.metric_intake_type import MetricIntakeType
+from datetime import timedelta
 
+import orjson
+import urllib3
 import voluptuous as vol
-from typing import Dict, List
-from datadog_api_client import ApiClient, Configuration
-from datadog_api_client.v2.api.metrics_api import MetricsApi
-from datadog_api_client.v2.model.metric_payload import MetricPayload
-from datadog_api_client.v2.model.metric_series import MetricSeries
-from datadog_api_client.v2.model.metric_point import MetricPoint
-from datadog_api_client.v2.model.intake_payload_accepted import IntakePayloadAccepted
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-from collections import namedtuple, defaultdict
+from collections import defaultdict, deque
 
 from homeassistant.const import (
     CONF_HOST,
     CONF_PORT,
     CONF_PREFIX,
+    EVENT_HOMEASSISTANT_STOP,
     EVENT_LOGBOOK_ENTRY,
     EVENT_STATE_CHANGED,
     STATE_UNKNOWN,
@@ -43,40 +56,94 @@ from homeassistant.const import (
 import homeassistant.helpers.config_validation as cv
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers.typing import ConfigType
-from homeassistant.helpers import state as state_helper
+from homeassistant.helpers.state import state_as_number
+from homeassistant.helpers.event import track_time_interval
 
 _LOGGER = logging.getLogger(__name__)
 
-MetricId = namedtuple("MetricId", ["name", "tags", "unit"])
-Value = namedtuple("Value", ["id", "timestamp", "value"])
-
-
-def send_values(dd_conf: Configuration, values: List[Value]) -> IntakePayloadAccepted:
-    with ApiClient(dd_conf) as client:
-        api = MetricsApi(client)
-
-        by_name: Dict[MetricId, List[MetricPoint]] = defaultdict(list)
-
-        for value in values:
-            by_name[value.id].append(
-                MetricPoint(timestamp=value.timestamp, value=value.value)
-            )
-
-        series: List[MetricSeries] = []
+# Plain tuples are used instead of namedtuples since one value is built per
+# attribute per event and namedtuple construction is noticeably slower.
+# (name, tags, unit)
+MetricId = Tuple[str, Tuple[str, ...], str]
+# (id, timestamp, value)
+Value = Tuple[MetricId, float, float]
+# Buffered points by metric id and timestamp (in seconds). The intake only
+# keeps the last value for a given timestamp so duplicates are dropped early.
+Points = Dict[MetricId, Dict[int, float]]
+
+
+_NUM_TYPES = (int, float)
+# Used to replace spaces in attribute names.
+_SPACE_TABLE = str.maketrans(" ", "_")
+
+# See https://docs.datadoghq.com/api/latest/metrics/#submit-metrics
+SERIES_URL = "https://api.{site}/api/v2/series"
+# A stalled request would block the worker thread, so always time out.
+HTTP_TIMEOUT = urllib3.Timeout(connect=5, read=30)
+# Value of the intake type enum for gauges.
+METRIC_TYPE_GAUGE = 3
+
+
+def compress(body: bytes) -> Tuple[bytes, str]:
+    # Payloads repeat the same tags on every series so they compress very
+    # well, zstd is preferred when available and gzip is used otherwise.
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(body), "zstd1"
+    return gzip.compress(body, compresslevel=1), "gzip"
+
+
+def send_values(
+    http: urllib3.PoolManager, url: str, api_key: str, points: Points
+) -> List[str]:
+    # The payload is built by hand rather than through the datadog_api_client
+    # models, whose per-attribute validation dominated the cost of a flush.
+    series: List[Dict[str, Any]] = []
+
+    for id_, by_ts in points.items():
+        name, tags, unit = id_
+        timestamps = list(by_ts)
+        # Points are buffered in the order events come in so they are almost
+        # always sorted already, only pay for the sort when they aren't.
+        if any(timestamps[i] < timestamps[i - 1] for i in range(1, len(timestamps))):
+            timestamps.sort()
+        series.append(
+            {
+                "metric": name,
+                "type": METRIC_TYPE_GAUGE,
+                "unit": unit,
+                # orjson encodes tuples as arrays, no need to copy them.
+                "tags": tags,
+                "points": [{"timestamp": t, "value": by_ts[t]} for t in timestamps],
+            }
+        )
 
-        for id, points in by_name.items():
-            points.sort(key=lambda p: p.timestamp)
-            serie = MetricSeries(
-                metric=id.name,
-                points=points,
-                tags=[*id.tags],
-                unit=id.unit,
-                type=MetricIntakeType.GAUGE,
-            )
-            series.append(serie)
+    body, encoding = compress(orjson.dumps({"series": series}))
+    res = http.request(
+        "POST",
+        url,
+        body=body,
+        headers={
+            "Content-Type": "application/json",
+            "Content-Encoding": encoding,
+            "DD-API-KEY": api_key,
+        },
+    )
+
+    errors: List[str] = []
+    # Error pages from proxies in front of the intake aren't JSON.
+    if res.data and res.headers.get("Content-Type", "").startswith(
+        "application/json"
+    ):
+        try:
+            resp = orjson.loads(res.data)
+        except orjson.JSONDecodeError:
+            resp = None
+        if isinstance(resp, dict):
+            errors = [str(e) for e in resp.get("errors") or []]
 
-        body = MetricPayload(series)
-        return api.submit_metrics(body=body)
+    if res.status >= 400 and not errors:
+        errors = [f"unexpected status {res.status}"]
+    return errors
 
 
 # The domain of your component. Should be equal to the name of your component.
@@ -88,16 +155,23 @@ CONF_PREFIX = "prefix"
 CONF_FLUSH_PERIOD_SEC = "flush_period_sec"
 CONF_API_KEY = "api_key"
 CONF_APP_KEY = "app_key"
+CONF_SITE = "site"
+
+def default_site() -> str:
+    # Same default as datadog_api_client used to pick.
+    return os.environ.get("DD_SITE", "datadoghq.com")
+
 
 CONFIG_SCHEMA = vol.Schema(
     {
         DOMAIN: vol.Schema(
             {
                 vol.Required(CONF_API_KEY): cv.string,
-                vol.Required(CONF_APP_KEY): cv.string,
+                vol.Optional(CONF_APP_KEY): cv.string,
                 vol.Optional(CONF_FLUSH_PERIOD_SEC, default=60): int,
                 vol.Optional(CONF_PREFIX, default="hass.datadog"): cv.string,
                 vol.Optional(CONF_TAGS, default=""): cv.string,
+                vol.Optional(CONF_SITE, default=default_site): cv.string,
             }
         )
     },
@@ -105,46 +179,174 @@ CONFIG_SCHEMA = vol.Schema(
 )
 
 
+# Upper bound on the number of points sent in a single request, a flush
+# is triggered as soon as the buffer reaches it.
+MAX_BUFFERED_POINTS = 10_000
+# Upper bound on the number of batches waiting for the worker, batches are
+# dropped past it so that a stalled worker doesn't grow memory unbounded.
+MAX_QUEUED_BATCHES = 10
+# How long to wait for the worker to send the remaining batches on stop.
+STOP_TIMEOUT_SEC = 10
+
+
+# Number of recent (entity_id, last_updated) pairs remembered to drop
+# duplicated state_changed events.
+SEEN_EVENTS_SIZE = 4096
+
+
 def ts() -> int:
     return int(time.time())
 
 
 class ValueBuffer:
-    def __init__(self, conf: Configuration, flush_period_sec: int):
-        self._b: List[Value] = []
+    def __init__(
+        self,
+        http: urllib3.PoolManager,
+        url: str,
+        api_key: str,
+        flush_period_sec: int,
+    ):
+        self._b: Points = defaultdict(dict)
+        # Number of points in self._b.
+        self._n = 0
         self._last_send: int = ts()
         self._flush_period_sec = flush_period_sec
-        self._conf = conf
-
-    def buffer_or_send(self, val: Value):
-        self._b.append(val)
-
-        now = ts()
-        if now - self._last_send > self._flush_period_sec:
-            res = send_values(self._conf, self._b)
-            self._last_send = now
-            if res.errors:
+        self._http = http
+        self._url = url
+        self._api_key = api_key
+        # Points are buffered from event listeners and flushed by a timer.
+        self._lock = threading.Lock()
+        # Set once stop was called, points buffered after that are ignored
+        # since nothing would send them.
+        self._stopped = False
+
+        # Batches are submitted from a dedicated thread so that the event bus
+        # is never blocked on a round-trip to the Datadog API.
+        self._queue: queue.Queue[Optional[Tuple[Points, int]]] = queue.Queue(
+            maxsize=MAX_QUEUED_BATCHES
+        )
+        self._worker = threading.Thread(
+            target=self._send_loop, name=DOMAIN, daemon=True
+        )
+        self._worker.start()
+
+    def _flush(self, now: int):
+        # Must be called with self._lock held.
+        if self._n:
+            try:
+                self._queue.put_nowait((self._b, self._n))
+            except queue.Full:
+                _LOGGER.error(
+                    "Too many batches waiting to be sent, dropping %d points",
+                    self._n,
+                )
+            self._b = defaultdict(dict)
+            self._n = 0
+        self._last_send = now
+
+    def buffer_or_send(self, val: Value, now: int):
+        id_, ts_, v = val
+        ts_ = int(ts_)
+
+        with self._lock:
+            if self._stopped:
+                return
+
+            by_ts = self._b[id_]
+            if ts_ not in by_ts:
+                self._n += 1
+            by_ts[ts_] = v
+
+            if (
+                self._n >= MAX_BUFFERED_POINTS
+                or now - self._last_send > self._flush_period_sec
+            ):
+                self._flush(now)
+
+    def flush(self, now: int):
+        with self._lock:
+            if not self._stopped:
+                self._flush(now)
+
+    def stop(self) -> bool:
+        # Send what's left in the buffer and wait for the worker to be done,
+        # returns whether it actually is.
+        with self._lock:
+            self._flush(ts())
+            self._stopped = True
+        try:
+            self._queue.put(None, timeout=STOP_TIMEOUT_SEC)
+        except queue.Full:
+            _LOGGER.error("Timed out stopping the worker, pending points are lost")
+            return False
+
+        self._worker.join(timeout=STOP_TIMEOUT_SEC)
+        if self._worker.is_alive():
+            _LOGGER.error("Timed out stopping the worker, pending points are lost")
+            return False
+        return True
+
+    def _send_loop(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+
+            points, n = batch
+            try:
+                errors = send_values(self._http, self._url, self._api_key, points)
+            except Exception:
+                _LOGGER.exception("An error occurred sending %d points", n)
+                continue
+
+            if errors:
                 _LOGGER.error(
                     "An error occurred sending %d points: %s",
-                    len(self._b),
-                    ",".join(res.errors),
+                    n,
+                    ",".join(errors),
                 )
-            self._b = []
 
 
 def setup(hass: HomeAssistant, config: ConfigType) -> bool:
     conf = config[DOMAIN]
 
-    dd_conf = Configuration()
-
-    default_tags = conf["tags"].split(",")
+    default_tags = tuple(conf["tags"].split(","))
     prefix = conf["prefix"]
     flush_period_sec = conf["flush_period_sec"]
 
-    dd_conf.api_key["apiKeyAuth"] = conf["api_key"]
-    dd_conf.api_key["appKeyAuth"] = conf["app_key"]
-
-    buffer = ValueBuffer(dd_conf, flush_period_sec)
+    # The pool manager is kept for the whole lifetime of the component so
+    # that its connections are reused across flushes.
+    http = urllib3.PoolManager(timeout=HTTP_TIMEOUT)
+    url = SERIES_URL.format(site=conf["site"])
+    buffer = ValueBuffer(http, url, conf["api_key"], flush_period_sec)
+
+    # Flush periodically so that points don't stay buffered when no event
+    # comes in.
+    cancel_flush_timer = track_time_interval(
+        hass,
+        lambda now: buffer.flush(int(now.timestamp())),
+        timedelta(seconds=flush_period_sec),
+    )
+
+    def shutdown(_):
+        cancel_flush_timer()
+        # Don't tear down the connections under a request that's still
+        # running, the worker is a daemon thread anyway.
+        if buffer.stop():
+            http.clear()
+
+    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, shutdown)
+
+    metric_id_cache: Dict[
+        str,
+        Tuple[
+            Tuple[str, str, str], str, Tuple[str, ...], MetricId, Dict[str, MetricId]
+        ],
+    ] = {}
+
+    seen: Deque[Tuple[str, float]] = deque(maxlen=SEEN_EVENTS_SIZE)
+    seen_set: Set[Tuple[str, float]] = set()
+    seen_lock = threading.Lock()
 
     # Will listen on new events and potentially buffer metrics to be sent
     # to the Datadog API.
@@ -154,40 +356,84 @@ def setup(hass: HomeAssistant, config: ConfigType) -> bool:
         if state is None or state.state == STATE_UNKNOWN:
             return
 
-        attrs = dict(state.attributes)
+        # Home Assistant can fire the same state change more than once (e.g. on
+        # restore), drop it before doing any work.
+        seen_key = (state.entity_id, state.last_updated_timestamp)
+        with seen_lock:
+            if seen_key in seen_set:
+                return
+            if len(seen) == SEEN_EVENTS_SIZE:
+                seen_set.discard(seen[0])
+            seen.append(seen_key)
+            seen_set.add(seen_key)
+
+        attrs = state.attributes
         device_class = attrs.get("device_class", "unknown_device")
         state_class = attrs.get("state_class", "unknown_state")
-        metric = f"{prefix}.{state.domain}.{device_class}.{state_class}"
-        tags = [
-            f"domain:{state.domain}",
-            f"entity_id:{state.entity_id}",
-            f"device_class:{device_class}",
-            f"state_class:{state_class}",
-        ] + default_tags
         unit = attrs.get("unit_of_measurement", "")
 
+        # The metric name and tags only change along with the device class,
+        # state class or unit of an entity, so they are cached per entity.
+        cache_key = (device_class, state_class, unit)
+        cached = metric_id_cache.get(state.entity_id)
+        if cached is not None and cached[0] == cache_key:
+            _, metric, tags, m_id, attr_ids = cached
+        else:
+            metric = f"{prefix}.{state.domain}.{device_class}.{state_class}"
+            tags = (
+                f"domain:{state.domain}",
+                f"entity_id:{state.entity_id}",
+                f"device_class:{device_class}",
+                f"state_class:{state_class}",
+            ) + default_tags
+            m_id = (metric, tags, unit)
+            # Metric ids of the nested attributes, filled as they show up.
+            attr_ids = {}
+            metric_id_cache[state.entity_id] = (
+                cache_key,
+                metric,
+                tags,
+                m_id,
+                attr_ids,
+            )
+
         ts = state.last_updated_timestamp
+        # Read the clock once per event, it's only used to decide when to flush.
+        now = int(time.time())
+        buffer_or_send = buffer.buffer_or_send
+        # Avoid building the debug log calls at all when they're not needed.
+        debug = _LOGGER.isEnabledFor(logging.DEBUG)
 
         for key, value in attrs.items():
-            if isinstance(value, (float, int)):
-                attribute = f"{metric}.{key.replace(' ', '_')}"
-                value = int(value) if isinstance(value, bool) else value
-
+            # Exact type checks first since most attributes are plain strings,
+            # isinstance is only needed for subclasses of int and float.
+            value_type = type(value)
+            if value_type is bool:
+                value = int(value)
+            elif value_type not in _NUM_TYPES and not isinstance(value, _NUM_TYPES):
+                continue
+
+            attr_id = attr_ids.get(key)
+            if attr_id is None:
                 # We don't set the unit here since we don't know what's the unit of this nested value.
-                m_id = MetricId(attribute, tuple(tags), "")
-                buffer.buffer_or_send(Value(m_id, ts, value))
-                _LOGGER.debug("Sent metric %s: %s (tags: %s)", attribute, value, tags)
+                safe_key = key.translate(_SPACE_TABLE) if " " in key else key
+                attr_id = (f"{metric}.{safe_key}", tags, "")
+                attr_ids[key] = attr_id
+
+            buffer_or_send((attr_id, ts, value), now)
+            if debug:
+                _LOGGER.debug("Sent metric %s: %s (tags: %s)", attr_id[0], value, tags)
 
         try:
-            value = state_helper.state_as_number(state)
+            value = state_as_number(state)
         except ValueError:
             _LOGGER.error("Error sending %s: %s (tags: %s)", metric, state.state, tags)
             return
 
-        m_id = MetricId(metric, tuple(tags), unit)
-        buffer.buffer_or_send(Value(m_id, ts, value))
+        buffer_or_send((m_id, ts, value), now)
 
-        _LOGGER.debug("Sent metric %s: %s (tags: %s)", metric, value, tags)
+        if debug:
+            _LOGGER.debug("Sent metric %s: %s (tags: %s)", metric, value, tags)
 
     hass.bus.listen(EVENT_STATE_CHANGED, state_changed_listener)
 